@@ -1,29 +1,622 @@
+import os
+import json
+import itertools
+import functools
+import multiprocessing
 import numpy as np
 import scipy.spatial
 import sys
 #sys.path.append('/Users/tabel/Research/codes/SEdist/')
 from SEdist import SE_distribution
+from kNN_instrument import NullProfile
 
-def VolumekNN(xin, xout, k=1, periodic=0):
+def _Cr(dim):
+    ''' Volume prefactor Cr of a ball, V = Cr r^dim, for 1, 2 and 3D. '''
+    return [2, np.pi, 4 * np.pi / 3][dim - 1]
+
+def VolumekNN(xin, xout, k=1, periodic=0, executor=None, nprocs=None, chunksize=None, cache=None,
+              dtype=np.float64, krange=False, profile=None, engine="kdtree", eps=0.1, refine=1):
+    ''' kNN volumes of the query points xout with respect to the data xin, one column per k.
+    Only the requested ranks are kept; with krange=True and an integer k all ranks 1..k
+    are returned. dtype=np.float32 halves the size of the result.
+    With an executor (see _map_chunks) the query points are split into slabs that are
+    queried in parallel against a single tree, and the volumes of all slabs are
+    concatenated. With a kNNCache the tree and the volumes of every k are looked up
+    before anything is computed. A kNNProfile given as profile collects timings.
+
+    engine selects how neighbours are found:
+      "kdtree"  exact cKDTree query (default)
+      "approx"  cKDTree query with tolerance eps: every distance is at most (1+eps) times
+                the true one, so every volume is at most (1+eps)^dim times too large and
+                the measured CDF obeys CDF(V/(1+eps)^dim) <= CDF_approx(V) <= CDF(V)
+      "grid"    GridVolumekNN, for query points on a regular lattice in a periodic box and
+                large k; its distance error of up to hm*(sqrt(dim)+1)/2 shrinks with the
+                mesh spacing hm = h/refine, but is large for small k (see there)
+    Only exact volumes are cached, and always in float64 whatever dtype asks for. '''
+    if krange: k = list(range(1, k + 1))
     if isinstance(k, int): k = [k] # 
-    dim = xin.shape[1]
-    xtree = scipy.spatial.cKDTree(xin, boxsize=periodic)
-    dis, disi = xtree.query(xout, k=k, n_jobs=-1)
-    vol = np.empty_like(dis) # same shape as distance including all k values
-    Cr = [2, np.pi, 4 * np.pi / 3][dim - 1]  # Volume prefactor for 1,2, 3D
-    for c, k in enumerate(np.nditer(np.array(k))):
-        vol[:,c] = Cr * dis[:,c]**dim
+    if isinstance(xout, (str, os.PathLike)):
+        xout = np.load(xout, mmap_mode='r')
+    profile = _profile(profile, xout)
+    with profile.run():
+        if engine == "grid":
+            with profile.stage("query", len(xout)):
+                return GridVolumekNN(xin, xout, k, periodic, refine=refine, dtype=dtype)
+        eps = eps if engine == "approx" else 0
+        if cache is not None and eps == 0:
+            return cache.volumes(xin, xout, k, periodic, lambda kk: _query(
+                _tree(xin, periodic, executor, cache, profile), xout, kk, executor, nprocs, chunksize,
+                np.float64, profile)).astype(dtype, copy=False)
+        return _query(_tree(xin, periodic, executor, profile=profile), xout, k, executor, nprocs, chunksize, dtype,
+                      profile, eps)
+
+def _query(xtree, xout, k, executor=None, nprocs=None, chunksize=None, dtype=np.float64, profile=NullProfile, eps=0):
+    if chunksize is None and not hasattr(xout, "__len__"):
+        raise ValueError("chunksize is required when xout is an iterable of arrays")
+    if executor is None and chunksize is None:
+        return _volumes(xtree, xout, k, dtype=dtype, profile=profile, eps=eps)
+    if chunksize is None:
+        chunksize = max(1, -(-len(xout) // (4 * _nworkers(executor, nprocs))))
+    # chunks carry their index so that the rows can be put back in order, in particular
+    # under MPI where every rank holds a strided subset of them
+    vols = list(_map_chunks(_chunk_volumes, (k, dtype, eps), xtree, enumerate(_chunks(xout, chunksize)),
+                            executor, nprocs, profile, lambda r: len(r[1])))
+    if executor == "mpi":
+        vols = sorted(itertools.chain.from_iterable(_mpi_comm().allgather(vols)), key=lambda r: r[0])
+    return np.concatenate([v for _, v in vols]) if vols else np.empty((0, len(k)), dtype=dtype)
+
+def _volumes(xtree, xout, k, workers=-1, dtype=np.float64, block=2**16, profile=NullProfile, eps=0):
+    ''' Volumes of the ranks in k only, written into one (len(xout), len(k)) array of dtype.
+    cKDTree.query always returns neighbour indices as well; querying in blocks of rows
+    lets those (and the float64 distances) be dropped block by block, and each block
+    of distances is turned into volumes in place. '''
+    dim = xtree.m
+    Cr = _Cr(dim)
+    vol = np.empty((len(xout), len(k)), dtype=dtype)
+    for i in range(0, len(xout), block):
+        with profile.stage("query", len(xout[i:i + block])):
+            dis, _ = xtree.query(xout[i:i + block], k=k, eps=eps, workers=workers)
+        with profile.stage("volumes", len(dis)):
+            dis **= dim
+            dis *= Cr
+            vol[i:i + block] = dis
+        profile.advance(len(dis))
     return vol
-    
-def CDFkNN(xin, xout, kneighbors=1, periodic=0,compress="none",Ninterpolants=500):
-    vol = VolumekNN(xin, xout, k=kneighbors, periodic=periodic)
-    cdfs = {k: SE_distribution(vol[:,c],compress=compress,Ninterpolants=Ninterpolants) \
-        for c,k in enumerate(kneighbors)}
-    return cdfs
 
-def CDFkNNDD(xin, kneighbors=1, periodic=0,compress="none",Ninterpolants=500):
-    vol = VolumekNN(xin, xin, k=kneighbors, periodic=periodic)
-    cdfs = {(k): SE_distribution(vol[:,c],compress=compress,Ninterpolants=Ninterpolants) \
-        for c,k in enumerate(kneighbors)}
+def GridVolumekNN(xin, xout, k, periodic, refine=1, dtype=np.float64):
+    ''' kNN volumes for query points xout that form a regular lattice (any order, equal spacing h
+    along every axis) filling a periodic box, without a tree. The data points are assigned
+    to their nearest lattice node, and the number of points within radius r of every node
+    is obtained for all nodes at once as an FFT convolution with a spherical top-hat, on a
+    mesh of spacing hm = h/refine whose every refine-th node is a query point. This is
+    done for radii in steps of hm/2 up to the radius that holds 4*max(k) points on average,
+    which gives all k in one pass; the number of FFTs, and so the cost, grows as
+    max(k)^(1/dim) rather than with the number of k. The k-th neighbour volume of a node is
+    interpolated linearly in volume between the two radii at which its count reaches k.
+    Counts are assigned to the volume of the mesh cells inside each discrete sphere
+    rather than to Cr r^dim, which removes the bias of the discretised spheres.
+    Accuracy: moving every point to its mesh node changes every kNN distance by at most
+    hm*sqrt(dim)/2, and the radius steps add at most hm/2. As that is fixed in hm, the
+    volumes are only good once the k-th neighbour distance r_k spans a few mesh cells.
+    In 3D with one lattice node per data point (r_1 ~ 0.6 hm) the median volume error is
+    about 55% for k=1, 15% for k=8 and 5% for k=50, and refine=2 hardly helps at 2^dim
+    times the cost; use the tree for small k. The engine pays off for large k, where a
+    tree query costs O(k) per point while the grid cost grows as max(k)^(1/dim): with
+    1e5 points on 32^3 nodes, k = 64, 256 and 1024 (r_k ~ 2-4 hm) take 0.03 s against
+    8 s for the tree on one core, at median volume errors of 5%, 2% and 1%. Nodes whose count does not reach
+    max(k) within the largest radius are queried exactly with a cKDTree. '''
+    # the counts reach the k in increasing order, so work on sorted k and restore the
+    # requested column order at the end
+    order = np.argsort(np.atleast_1d(k), kind='stable')
+    k = np.atleast_1d(k)[order]
+    dim = xin.shape[1]
+    if not np.any(periodic):
+        raise ValueError("the grid engine needs a periodic box")
+    box = np.broadcast_to(np.asarray(periodic, dtype=float), (dim,))
+    axes = [np.unique(xout[:, d]) for d in range(dim)]
+    shape = tuple(len(a) for a in axes)
+    h = box[0] / shape[0]
+    if (np.prod(shape) != len(xout) or not np.allclose(box / shape, h)
+            or not all(np.allclose(np.diff(a), h) for a in axes)):
+        raise ValueError("the grid engine needs query points on a regular lattice filling the box")
+    origin = np.array([a[0] for a in axes])
+    h, shape = h / refine, tuple(refine * n for n in shape)
+    node = lambda x: np.ravel_multi_index(tuple((np.rint((x - origin) / h).astype(np.int64) % shape).T), shape)
+    rho = np.bincount(node(xin), minlength=np.prod(shape)).reshape(shape).astype(float)
+    frho = np.fft.rfftn(rho)
+    # periodic distance of every node from node 0, for the top-hat kernels
+    r2 = sum(np.minimum(i, n - i).reshape([-1 if a == d else 1 for a in range(dim)])**2
+             for d, (i, n) in enumerate(zip(map(np.arange, shape), shape))) * h**2
+    Cr = _Cr(dim)
+    vbar = np.prod(box) / len(xin)
+    rmax = (4 * max(k) * vbar / Cr)**(1 / dim)
+    nodes = node(xout)
+    vol = np.full((len(xout), len(k)), np.nan)
+    vprev, cprev = 0., np.zeros(len(xout))
+    for r in h / 2 * np.arange(1, int(np.ceil(2 * rmax / h)) + 1):
+        kernel = (r2 <= r**2).astype(float)
+        v = kernel.sum() * h**dim # volume of the cells of the discrete sphere
+        if v == vprev:
+            continue
+        count = np.rint(np.fft.irfftn(frho * np.fft.rfftn(kernel), s=shape)).ravel()[nodes]
+        # only the k between the smallest previous and the largest current count can be reached now
+        for c in range(np.searchsorted(k, cprev.min(), side='right'), np.searchsorted(k, count.max(), side='right')):
+            new = np.isnan(vol[:, c]) & (count >= k[c])
+            vol[new, c] = vprev + (k[c] - cprev[new]) / (count[new] - cprev[new]) * (v - vprev)
+        vprev, cprev = v, count
+    missing = np.isnan(vol).any(axis=1)
+    if missing.any():
+        vol[missing] = _volumes(scipy.spatial.cKDTree(xin, boxsize=periodic), xout[missing], k)
+    vol[:, order] = vol.copy()
+    return vol.astype(dtype, copy=False)
+
+def _tree(xin, periodic=0, executor=None, cache=None, profile=NullProfile):
+    ''' Builds the tree once, or takes it from the cache. Under MPI rank 0 builds it
+    and broadcasts it to the other ranks. '''
+    with profile.stage("tree", len(xin)):
+        if executor == "mpi":
+            comm = _mpi_comm()
+            xtree = _tree(xin, periodic, cache=cache) if comm.rank == 0 else None
+            return comm.bcast(xtree, root=0)
+        if cache is not None:
+            return cache.tree(xin, periodic)
+        return scipy.spatial.cKDTree(xin, boxsize=periodic)
+
+def _vbar(xin, periodic=0, n=None):
+    ''' Mean volume per data point: the box (or bounding box) volume over n, default len(xin). '''
+    dim = xin.shape[1]
+    if np.any(periodic):
+        span = np.prod(np.broadcast_to(periodic, (dim,)))
+    else:
+        span = np.prod(np.ptp(xin, axis=0))
+    return span / (len(xin) if n is None else n)
+
+def _profile(profile, xout):
+    if profile is None:
+        return NullProfile
+    if hasattr(xout, '__len__') and not isinstance(xout, (str, os.PathLike)):
+        profile.total = len(xout)
+    return profile
+
+def _chunks(xout, chunksize):
+    ''' Yields the query points in pieces of at most chunksize rows. xout may be an array,
+    the path of a .npy file (which is memory-mapped rather than read) or any iterable
+    of arrays such as a generator. '''
+    if isinstance(xout, (str, os.PathLike)):
+        xout = np.load(xout, mmap_mode='r')
+    if isinstance(xout, np.ndarray):
+        xout = [xout]
+    for x in xout:
+        for i in range(0, len(x), chunksize):
+            yield np.asarray(x[i:i + chunksize])
+
+# Parallel execution. The executor argument of VolumekNN, HistogramkNN, CDFkNN and
+# CDFkNNDD selects how chunks of query points are distributed:
+#   None       one process, cKDTree.query itself uses all cores (workers=-1)
+#   "process"  a forked multiprocessing pool of nprocs workers; the tree is inherited
+#              through fork (copy-on-write) instead of being pickled to every worker
+#   "mpi"      every rank of MPI.COMM_WORLD (mpi4py) takes every size-th chunk; rank 0
+#              builds the tree and broadcasts it, and the partial results are merged
+#              exactly (histogram counts are summed, volumes are gathered)
+#   any object with a concurrent.futures style map(func, iterable) method
+_forked_shared = None # set right before the pool forks, read by the workers
+
+def _mpi_comm():
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        raise ImportError('executor="mpi" requires mpi4py')
+    return MPI.COMM_WORLD
+
+def _nworkers(executor, nprocs=None):
+    if executor == "mpi":
+        return _mpi_comm().size
+    return nprocs or os.cpu_count()
+
+def _chunk_volumes(xtree, args, chunk, workers=-1, profile=NullProfile):
+    k, dtype, eps = args
+    i, x = chunk
+    return i, _volumes(xtree, x, k, workers, dtype, profile=profile, eps=eps)
+
+def _chunk_histogram(xtree, args, x, workers=-1, profile=NullProfile):
+    k, vrange, nbins, eps = args
+    vol = _volumes(xtree, x, k, workers, profile=profile, eps=eps)
+    with profile.stage("histogram", len(vol)):
+        return VolumeHistogram(k, *vrange, nbins=nbins).add(vol)
+
+def _forked(func, args, x):
+    return func(_forked_shared, args, x, workers=1)
+
+def _pool_map(func, shared, chunks, nprocs):
+    global _forked_shared
+    _forked_shared = shared
+    try:
+        with multiprocessing.get_context("fork").Pool(nprocs) as pool:
+            yield from pool.imap(func, chunks)
+    finally:
+        _forked_shared = None
+
+def _map_chunks(func, args, shared, chunks, executor=None, nprocs=None, profile=NullProfile, nrows=None):
+    ''' Applies func(shared, args, chunk) to the chunks with the selected executor and
+    returns an iterator over the results of this process (or MPI rank). shared is the
+    large object all chunks need, usually the tree, and is what gets inherited
+    through fork. In process the profile is handed on to func; for the other executors
+    the wait for each result is timed as the query stage and nrows(result) query
+    points are reported as done. '''
+    if executor is None:
+        return (func(shared, args, x, profile=profile) for x in chunks)
+    if executor == "process":
+        results = _pool_map(functools.partial(_forked, func, args), shared, chunks, nprocs)
+    elif executor == "mpi":
+        comm = _mpi_comm()
+        results = (func(shared, args, x) for x in itertools.islice(chunks, comm.rank, None, comm.size))
+    else:
+        results = executor.map(functools.partial(func, shared, args), chunks)
+    return _profiled(results, profile, nrows)
+
+def _profiled(results, profile, nrows):
+    results = iter(results)
+    while True:
+        with profile.stage("query"):
+            r = next(results, StopIteration)
+        if r is StopIteration:
+            return
+        profile.advance(nrows(r))
+        yield r
+
+class VolumeHistogram:
+    ''' Per-k histograms of kNN volumes on one common set of logarithmic bins.
+    Volumes are added chunk by chunk so memory does not grow with the number of
+    query points, and histograms sharing their bins merge exactly. Volumes
+    outside [vmin, vmax] are counted in the first or last bin.
+    '''
+    def __init__(self, kneighbors, vmin, vmax, nbins=4096):
+        self.kneighbors = list(np.atleast_1d(kneighbors))
+        self.edges = np.geomspace(vmin, vmax, nbins + 1)
+        self.counts = np.zeros((len(self.kneighbors), nbins), dtype=np.int64)
+
+    def add(self, vol):
+        nk, nbins = self.counts.shape
+        idx = np.clip(np.searchsorted(self.edges, vol, side='right') - 1, 0, nbins - 1)
+        idx += nbins * np.arange(nk)
+        self.counts += np.bincount(idx.ravel(), minlength=nk * nbins).reshape(nk, nbins)
+        return self
+
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+    def cdf(self, c, v):
+        ''' Fraction of query points whose kneighbors[c] volume is below v. '''
+        cum = np.concatenate(([0], np.cumsum(self.counts[c])))
+        return np.interp(np.log(v), np.log(self.edges), cum) / cum[-1]
+
+    def quantile(self, c, p):
+        ''' Volumes below which a fraction p of the kneighbors[c] volumes lie,
+        interpolated log-linearly within the bins. '''
+        cum = np.concatenate(([0], np.cumsum(self.counts[c])))
+        return np.exp(np.interp(np.asarray(p) * cum[-1], cum, np.log(self.edges)))
+
+    def sample(self, c, n=None):
+        ''' Volumes at n evenly spaced quantiles of the kneighbors[c] histogram.
+        This stands in for the raw volumes when building an SE_distribution. '''
+        if n is None: n = min(self.counts[c].sum(), 2**20)
+        return self.quantile(c, (np.arange(n) + 0.5) / n)
+
+class CDFArray:
+    ''' kNN CDFs of all k in one contiguous (n_k, n_interp) array: vol[c, j] is the volume
+    below which a fraction p[j] of the query points have their kneighbors[c]-th neighbour.
+    The levels p are shared by all k; compress="log" places them logarithmically towards
+    both tails (like a peaked CDF), "none" evenly. Metadata: kneighbors, boxsize,
+    N (data points), Nquery and compress. Rows are returned as views, and save/load
+    keep everything in one file that is read back memory-mapped.
+    '''
+    _magic = b"kNNCDF01"
+
+    def __init__(self, vol, p, kneighbors, boxsize=0, N=0, Nquery=0, compress="none"):
+        self.vol, self.p = vol, p
+        self.kneighbors = [int(k) for k in np.atleast_1d(kneighbors)]
+        self.boxsize, self.N, self.Nquery, self.compress = boxsize, N, Nquery, compress
+        self._row = {k: c for c, k in enumerate(self.kneighbors)}
+
+    @staticmethod
+    def levels(n, compress="none", Nquery=None):
+        if compress == "log":
+            pmin = 0.5 / Nquery if Nquery else 1e-6
+            return np.concatenate((np.geomspace(pmin, 0.5, n - n // 2),
+                                   1 - np.geomspace(pmin, 0.5, n // 2, endpoint=False)[::-1]))
+        return (np.arange(n) + 0.5) / n
+
+    @classmethod
+    def from_volumes(cls, vol, kneighbors, Ninterpolants=500, compress="none", boxsize=0, N=0):
+        p = cls.levels(Ninterpolants, compress, len(vol))
+        q = np.ascontiguousarray(np.quantile(vol, p, axis=0).T)
+        return cls(q, p, kneighbors, boxsize, N, len(vol), compress)
+
+    @classmethod
+    def from_histogram(cls, hist, Ninterpolants=500, compress="none", boxsize=0, N=0):
+        Nquery = int(hist.counts[0].sum())
+        p = cls.levels(Ninterpolants, compress, Nquery)
+        q = np.array([hist.quantile(c, p) for c in range(len(hist.kneighbors))])
+        return cls(q, p, hist.kneighbors, boxsize, N, Nquery, compress)
+
+    def __getitem__(self, k):
+        ''' Volumes at the levels p for one k, a view into vol. '''
+        return self.vol[self._row[k]]
+
+    def select(self, kneighbors):
+        ''' CDFArray for a subset of k; a view when those k are stored contiguously. '''
+        rows = [self._row[k] for k in kneighbors]
+        if rows == list(range(rows[0], rows[-1] + 1)):
+            vol = self.vol[rows[0]:rows[-1] + 1]
+        else:
+            vol = self.vol[rows]
+        return CDFArray(vol, self.p, kneighbors, self.boxsize, self.N, self.Nquery, self.compress)
+
+    def cdf(self, v):
+        ''' CDF of every k at every volume in v, shape (n_k, len(v)). All rows are
+        interpolated in one searchsorted call: every row is rescaled to [0, 1] and
+        shifted by twice its index, which works whatever the units of the volumes. '''
+        v = np.asarray(v, dtype=float)
+        nk, n = self.vol.shape
+        rows = np.arange(nk)[:, None]
+        lo, hi = self.vol[:, :1], self.vol[:, -1:]
+        scale = np.where(hi > lo, hi - lo, 1)
+        flat = ((self.vol - lo) / scale + 2 * rows).ravel()
+        vc = np.clip(v[None, :], lo, hi)
+        j = np.clip(np.searchsorted(flat, (vc - lo) / scale + 2 * rows) - rows * n, 1, n - 1)
+        v0, v1 = self.vol[rows, j - 1], self.vol[rows, j]
+        t = np.where(v1 > v0, (vc - v0) / np.where(v1 > v0, v1 - v0, 1), 1)
+        cdf = self.p[j - 1] + t * (self.p[j] - self.p[j - 1])
+        return np.clip(np.where(v < lo, 0, np.where(v >= hi, 1, cdf)), 0, 1)
+
+    def pcdf(self, v):
+        ''' Peaked CDF, min(CDF, 1-CDF), of every k at every volume in v. '''
+        cdf = self.cdf(v)
+        return np.minimum(cdf, 1 - cdf)
+
+    def mean(self):
+        ''' Mean volume of every k; each level carries the probability between its midpoints to its neighbours. '''
+        edges = np.concatenate(([0], 0.5 * (self.p[1:] + self.p[:-1]), [1]))
+        return self.vol @ np.diff(edges)
+
+    def save(self, filename):
+        ''' One file: magic, header length, JSON header padded to 64 bytes, then p and vol as float64. '''
+        header = json.dumps(dict(kneighbors=self.kneighbors, boxsize=np.asarray(self.boxsize).tolist(),
+                                 N=int(self.N), Nquery=int(self.Nquery), compress=self.compress,
+                                 shape=list(self.vol.shape))).encode()
+        header += b" " * (-(len(self._magic) + 8 + len(header)) % 64)
+        with open(filename, "wb") as f:
+            f.write(self._magic + np.uint64(len(header)).tobytes() + header)
+            f.write(np.ascontiguousarray(self.p, dtype=np.float64).tobytes())
+            f.write(np.ascontiguousarray(self.vol, dtype=np.float64).tobytes())
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        with open(filename, "rb") as f:
+            if f.read(len(cls._magic)) != cls._magic:
+                raise ValueError("%s is not a CDFArray file" % filename)
+            length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            meta = json.loads(f.read(length))
+        offset = len(cls._magic) + 8 + length
+        nk, n = meta.pop("shape")
+        data = np.memmap(filename, dtype=np.float64, mode="r", offset=offset, shape=(n + nk * n,))
+        if not mmap:
+            data = np.array(data)
+        return cls(data[n:].reshape(nk, n), data[:n], **meta)
+
+def HistogramkNN(xin, xout, kneighbors=1, periodic=0, chunksize=2**20, nbins=4096, vrange=None,
+                 executor=None, nprocs=None, cache=None, profile=None, engine="kdtree", eps=0.1, refine=1):
+    ''' Streams the query points through one tree in chunks of chunksize and reduces
+    the kNN volumes of every chunk straight into a VolumeHistogram. Peak memory
+    depends on chunksize only. By default the bins span 1e-12 to 1e3*max(k) times
+    the mean volume per data point. engine, eps and refine are those of VolumekNN; the grid
+    engine needs the whole lattice at once and so does not stream. '''
+    kneighbors = list(np.atleast_1d(kneighbors))
+    profile = _profile(profile, xout)
+    with profile.run():
+        if vrange is None:
+            vbar = _vbar(xin, periodic)
+            vrange = (1e-12 * vbar, 1e3 * max(kneighbors) * vbar)
+        hist = VolumeHistogram(kneighbors, *vrange, nbins=nbins)
+        if engine == "grid":
+            vol = VolumekNN(xin, xout, kneighbors, periodic, profile=profile, engine=engine, refine=refine)
+            with profile.stage("histogram", len(vol)):
+                return hist.add(vol)
+        eps = eps if engine == "approx" else 0
+        xtree = _tree(xin, periodic, executor, cache, profile)
+        for h in _map_chunks(_chunk_histogram, (kneighbors, vrange, nbins, eps), xtree,
+                             _chunks(xout, chunksize), executor, nprocs,
+                             profile, lambda h: h.counts[0].sum()):
+            with profile.stage("histogram"):
+                hist.merge(h)
+        if executor == "mpi":
+            from mpi4py import MPI
+            _mpi_comm().Allreduce(MPI.IN_PLACE, hist.counts, op=MPI.SUM)
+        return hist
+
+def CDFkNN(xin, xout, kneighbors=1, periodic=0,compress="none",Ninterpolants=500,chunksize=None,
+           executor=None, nprocs=None, cache=None, compact=False, profile=None, engine="kdtree", eps=0.1,
+           refine=1):
+    ''' kNN CDFs of the query points xout around the data xin, as a dict {k: SE_distribution},
+    or with compact=True as a single CDFArray. A kNNProfile given as profile times every
+    stage; its report() is available afterwards and is passed to its sink. See VolumekNN
+    for the choice of engine and its eps and refine. '''
+    kneighbors = np.atleast_1d(kneighbors)
+    with (profile or NullProfile).run():
+        if chunksize is not None:
+            hist = HistogramkNN(xin, xout, kneighbors, periodic=periodic, chunksize=chunksize,
+                                executor=executor, nprocs=nprocs, cache=cache, profile=profile,
+                                engine=engine, eps=eps, refine=refine)
+            return _fit(hist.sample, kneighbors, compress, Ninterpolants, compact, profile,
+                        lambda: CDFArray.from_histogram(hist, Ninterpolants, compress, periodic, len(xin)))
+        vol = VolumekNN(xin, xout, k=kneighbors, periodic=periodic, executor=executor, nprocs=nprocs, cache=cache,
+                        profile=profile, engine=engine, eps=eps, refine=refine)
+        return _fit(lambda c: vol[:,c], kneighbors, compress, Ninterpolants, compact, profile,
+                    lambda: CDFArray.from_volumes(vol, kneighbors, Ninterpolants, compress, periodic, len(xin)))
+
+def CDFkNNDD(xin, kneighbors=1, periodic=0,compress="none",Ninterpolants=500,executor=None,nprocs=None,
+             cache=None, compact=False, profile=None):
+    kneighbors = np.atleast_1d(kneighbors)
+    with (profile or NullProfile).run():
+        vol = VolumekNN(xin, xin, k=kneighbors, periodic=periodic, executor=executor, nprocs=nprocs, cache=cache,
+                        profile=profile)
+        return _fit(lambda c: vol[:,c], kneighbors, compress, Ninterpolants, compact, profile,
+                    lambda: CDFArray.from_volumes(vol, kneighbors, Ninterpolants, compress, periodic, len(xin)))
+
+def _fit(volumes, kneighbors, compress, Ninterpolants, compact, profile, cdfarray):
+    ''' The results of CDFkNN and CDFkNNDD from volumes(c), the volumes of kneighbors[c]; the
+    keys may be any labels, such as the tracer and k tuples of CDFkNNCross. '''
+    profile = profile or NullProfile
+    with profile.stage("fit", len(kneighbors)):
+        if compact:
+            cdfs = cdfarray()
+        else:
+            cdfs = {k: SE_distribution(volumes(c),compress=compress,Ninterpolants=Ninterpolants) \
+                for c,k in enumerate(kneighbors)}
     return cdfs
 
+def WeightedVolumekNN(xtree, xout, k, weights, workers=-1, block=2**14):
+    ''' Volumes of the smallest spheres around xout that enclose a total weight of at least k,
+    for every row of weights (shape (nw, N), one weight per data point of xtree). Integer
+    weights are point multiplicities, e.g. bootstrap resamplings, and 0/1 weights select
+    subsamples, all from the one tree. Neighbours are fetched in blocks of query points,
+    doubling the number fetched for points that have not yet reached weight max(k).
+    Returns an array of shape (nw, len(xout), len(k)). '''
+    k = np.atleast_1d(k)
+    weights = np.atleast_2d(weights)
+    dim, n = xtree.m, xtree.n
+    Cr = _Cr(dim)
+    vol = np.full((len(weights), len(xout), len(k)), np.inf)
+    for i in range(0, len(xout), block):
+        todo = np.arange(i, min(i + block, len(xout)))
+        nq = min(2 * max(k), n)
+        while len(todo):
+            dis, idx = xtree.query(xout[todo], k=nq, workers=workers)
+            dis, idx = dis.reshape(len(todo), -1), idx.reshape(len(todo), -1)
+            cw = np.cumsum(weights[:, idx], axis=-1) # (nw, len(todo), nq)
+            for c, kk in enumerate(k):
+                reached = cw[..., -1] >= kk
+                pos = np.argmax(cw >= kk, axis=-1)
+                v = Cr * np.take_along_axis(dis[None], pos[..., None], axis=-1)[..., 0]**dim
+                vol[:, todo, c] = np.where(reached, v, np.inf)
+            if nq == n: break
+            todo = todo[(cw[..., -1] < max(k)).any(axis=0)]
+            nq = min(2 * nq, n)
+    return vol
+
+def _ecdf(vol, vgrid):
+    ''' Fraction of rows of vol (N, nk) at or below every volume of vgrid, shape (nk, len(vgrid)). '''
+    vol = np.sort(vol, axis=0)
+    return np.array([np.searchsorted(vol[:, c], vgrid, side='right') for c in range(vol.shape[1])]) / len(vol)
+
+def _catalog_cdf(xout, args, catalog, workers=-1, profile=NullProfile):
+    k, periodic, vgrid = args
+    i, xin = catalog
+    with profile.stage("tree", len(xin)):
+        xtree = scipy.spatial.cKDTree(xin, boxsize=periodic)
+    return i, _ecdf(_volumes(xtree, xout, k, workers, profile=profile), vgrid)
+
+def CDFkNNBatch(xin, xout, kneighbors=1, periodic=0, vgrid=None, labels=None, jackknife=False,
+                weights=None, executor=None, nprocs=None):
+    ''' kNN CDFs of many catalogs against the same query points, stacked into an array of
+    shape (ncatalogs, len(kneighbors), len(vgrid)) on one common volume grid. The catalogs are
+      - a list of arrays xin,
+      - one array xin with per-point labels: one catalog per label value, or with
+        jackknife=True the catalogs that leave out one label each,
+      - one array xin with weights of shape (ncatalogs, N), see WeightedVolumekNN;
+        all catalogs then share a single tree and a single neighbour search.
+    Separate catalogs are distributed with the executor (see _map_chunks), which shares
+    xout with forked workers. By default vgrid spans 1e-3 to 10*max(k) times the
+    mean volume per point of the first catalog, 256 log-spaced values. '''
+    kneighbors = np.atleast_1d(kneighbors)
+    if labels is not None:
+        ulabels = np.unique(labels)
+        xin = [xin[(labels != l) if jackknife else (labels == l)] for l in ulabels]
+    if vgrid is None:
+        x0 = xin if weights is not None else xin[0]
+        vbar = _vbar(x0, periodic, None if weights is None else np.sum(weights[0]))
+        vgrid = vbar * np.geomspace(1e-3, 10 * max(kneighbors), 256)
+    if weights is not None:
+        xtree = scipy.spatial.cKDTree(xin, boxsize=periodic)
+        vol = WeightedVolumekNN(xtree, xout, kneighbors, weights)
+        return np.array([_ecdf(v, vgrid) for v in vol])
+    results = list(_map_chunks(_catalog_cdf, (kneighbors, periodic, vgrid), xout,
+                               enumerate(xin), executor, nprocs, nrows=lambda r: len(xout)))
+    if executor == "mpi":
+        results = [r for part in _mpi_comm().allgather(results) for r in part]
+    return np.array([cdf for i, cdf in sorted(results, key=lambda r: r[0])])
+
+def CDFMeanCov(cdfs, method="bootstrap"):
+    ''' Mean and covariance of a stack of CDFs from CDFkNNBatch, flattened over (k, volume),
+    so the covariance has shape (nk*nvol, nk*nvol). method="jackknife" scales the
+    scatter of the leave-one-out catalogs by (n-1)/n, "bootstrap" (or independent
+    realisations) by 1/(n-1). '''
+    n = len(cdfs)
+    x = cdfs.reshape(n, -1)
+    mean = x.mean(axis=0)
+    d = x - mean
+    norm = (n - 1) / n if method == "jackknife" else 1 / (n - 1)
+    return mean.reshape(cdfs.shape[1:]), norm * (d.T @ d)
+
+def CDFkNNCross(xins, xout, kneighbors=1, periodic=0, weights=None, thresholds=None,
+                compress="none", Ninterpolants=500, chunksize=None):
+    ''' Marginal and joint kNN CDFs of several tracers around the same query points, from one
+    tree per tracer and one pass over xout. xins is a dict {name: points} (or a list, named
+    by position). The result is a dict of SE_distribution with keys
+      (A, k)          CDF of the k-th neighbour volume of tracer A, as in CDFkNN
+      (A, k1, B, k2)  joint CDF of having at least k1 points of A and k2 points of B
+                      within V, i.e. the distribution of max(V_k1^A, V_k2^B)
+    for all tracers A before B and all k, k1, k2 in kneighbors.
+    weights is a dict {name: per-point weights} (masses). With thresholds {name: [m, ...]}
+    tracer A is replaced by the subsamples (A, m) of points with weight >= m. Tracers that
+    have weights but no thresholds use weighted neighbours: V_k is the smallest volume
+    enclosing a total weight of k (see WeightedVolumekNN). A ValueError is raised for
+    thresholds without weights, and for tracers (or subsamples) whose total weight or
+    number of points is below max(kneighbors), as their volumes would be infinite.
+    With chunksize the query points are streamed and every distribution is reduced to
+    a VolumeHistogram as in HistogramkNN. '''
+    if not isinstance(xins, dict): xins = dict(enumerate(xins))
+    weights, thresholds = weights or {}, thresholds or {}
+    kneighbors = list(np.atleast_1d(kneighbors))
+    trees = {}
+    for name, x in xins.items():
+        w = weights.get(name)
+        if name in thresholds and w is None:
+            raise ValueError("thresholds for tracer %r need its weights" % (name,))
+        # volumes that can never reach k would be inf and spoil every CDF they enter
+        if name in thresholds:
+            for m in thresholds[name]:
+                if np.count_nonzero(w >= m) < max(kneighbors):
+                    raise ValueError("tracer %r has fewer than %d points with weight >= %g"
+                                     % (name, max(kneighbors), m))
+                trees[(name, m)] = (scipy.spatial.cKDTree(x[w >= m], boxsize=periodic), None)
+        else:
+            if (len(x) if w is None else np.sum(w)) < max(kneighbors):
+                raise ValueError("tracer %r has a total weight (or number of points) below %d"
+                                 % (name, max(kneighbors)))
+            trees[name] = (scipy.spatial.cKDTree(x, boxsize=periodic), w)
+    names = list(trees)
+    keys = [(a, k) for a in names for k in kneighbors]
+    keys += [(a, k1, b, k2) for i, a in enumerate(names) for b in names[i + 1:]
+             for k1 in kneighbors for k2 in kneighbors]
+
+    def joint(x):
+        vol = {}
+        for a, (xtree, w) in trees.items():
+            v = _volumes(xtree, x, kneighbors) if w is None else WeightedVolumekNN(xtree, x, kneighbors, w)[0]
+            vol.update({(a, k): v[:, c] for c, k in enumerate(kneighbors)})
+        return np.stack([vol[key] if len(key) == 2 else np.maximum(vol[key[:2]], vol[key[2:]])
+                         for key in keys], axis=1)
+
+    if chunksize is None:
+        vol = joint(xout)
+        sample = lambda c: vol[:, c]
+    else:
+        # weighted tracers reach weight k over many points, so their volumes scale with the total weight
+        vbar = max(_vbar(xtree.data, periodic, None if w is None else np.sum(w)) for xtree, w in trees.values())
+        hist = VolumeHistogram(np.arange(len(keys)), 1e-12 * vbar, 1e3 * max(kneighbors) * vbar)
+        for x in _chunks(xout, chunksize):
+            hist.add(joint(x))
+        sample = hist.sample
+    return _fit(sample, keys, compress, Ninterpolants, False, None, None)
@@ -1,3 +1,6 @@
+import math
+import itertools
+import warnings
 import numpy as np
 from scipy.special import gamma, gammaln
 
@@ -34,6 +37,8 @@ def PGaussian(k, nV, sig):
 	for more detail of the Gaussian random field aspect and equation 8 in that paper
 	which define these P_{k|V}. 	
 	'''
+	if k > 20:
+		return PGaussianAll(k, nV, sig)[k]
 	return { 0: OneMinusPGg0 \
 			,1: PG1 \
 			,2: PG2 \
@@ -65,6 +70,8 @@ def CDFGaussian(k, nV, sig):
 	for more detail of the Gaussian random field aspect and equation 8 in that paper
 	which define these P_{k|V}. 	
 	'''
+	if k > 13:
+		return CDFGaussianAll(k, nV, sig)[k]
 	return { 0: PGg0 \
 			,1: PGg1 \
 			,2: PGg2 \
@@ -81,6 +88,237 @@ def CDFGaussian(k, nV, sig):
 			,13: PGg13 \
 		}.get(k, PGg0)(nV, sig)    # PG_0 will be returned default if x is not found
 
+def PGaussianAll(kmax, nV, sig):
+	''' All P_{k|V} for k = 0..kmax of the Gaussian random field at once, as an array of
+	shape (kmax+1,) + nV.shape. Same series as PGaussian, i.e. the coefficients of the
+	generating function G(x) = exp(nV (x-1) + nV^2 sig^2/2 (x-1)^2) (see the Mathematica
+	source below), but obtained from the recursion that follows from differentiating G,
+		(k+1) P_{k+1} = (nV - nV^2 sig^2) P_k + nV^2 sig^2 P_{k-1}, P_0 = exp(-nV + nV^2 sig^2/2).
+	The recursion runs on rescaled values with the logarithm of the scale carried along,
+	so intermediate powers and exponentials can neither overflow nor produce NaNs, and
+	kmax is not limited to the hand expanded polynomials.
+	Where nV sig^2 > 1 the P_{k|V} alternate in sign and are no probabilities; they are
+	NaN there, with a RuntimeWarning.
+	'''
+	nV, sig = np.broadcast_arrays(np.asarray(nV, dtype=float), np.asarray(sig, dtype=float))
+	bad = _unphysical(nV.ravel(), sig.ravel())
+	series = itertools.islice(_PGaussianSeries(np.where(bad, 0, nV.ravel()), sig.ravel()), kmax + 1)
+	P = np.array(list(series))
+	P[:, bad] = np.nan
+	return P.reshape((kmax + 1,) + nV.shape)
+
+def _unphysical(nV, sig):
+	''' Mask of nV sig^2 > 1, with a RuntimeWarning if it selects anything. '''
+	bad = nV * sig**2 > 1
+	if bad.any():
+		warnings.warn("nV sig^2 > 1, where the Gaussian P_{k|V} are unphysical, gives NaN",
+			RuntimeWarning, stacklevel=3)
+	return bad
+
+def _PGaussianSeries(nV, sig):
+	''' Yields P_0, P_1, P_2, ... of PGaussianAll without end. Sending a boolean mask
+	instead of calling next() restricts this and all later terms to the elements it selects.
+	The recursion runs on the P_k divided by exp(logscale), which are brought back to order
+	one only once one of them grows past 1e8, so most terms cost a multiplication by the
+	stored exp(logscale) rather than an exponential and a rescaling. Needs nV sig^2 <= 1,
+	where all of a, b and the P_k are non-negative and exp(logscale) cannot overflow. '''
+	b = nV**2 * sig**2
+	a = nV - b
+	logscale = -nV + b / 2
+	factor = np.exp(logscale)
+	prev, cur = np.zeros_like(nV), np.ones_like(nV)
+	k = 0
+	while True:
+		keep = yield cur * factor
+		if keep is not None:
+			a, b, prev, cur, logscale, factor = a[keep], b[keep], prev[keep], cur[keep], logscale[keep], factor[keep]
+		prev, cur = cur, (a * cur + b * prev) / (k + 1)
+		k += 1
+		if len(cur) and cur.max() > 1e8:
+			# elements that shrink keep their scale, only the large ones are brought back
+			scale = np.maximum(np.maximum(cur, prev), 1)
+			prev /= scale
+			cur /= scale
+			logscale = logscale + np.log(scale)
+			factor = np.exp(logscale)
+
+def CDFGaussianAll(kmax, nV, sig):
+	''' All CDFs of finding >k points, k = 0..kmax, as in CDFGaussian. Returns an array of
+	shape (kmax+1,) + nV.shape. Where the cumulative sum of PGaussianAll is below 1/2 the
+	CDF is 1 minus that sum; above it 1 - sum would cancel (and turn negative in the small
+	nV tail), so there the CDF is the sum of P_j over j > k instead, with the series run
+	on past kmax until its terms fall below the double precision of that sum. As for
+	PGaussianAll the CDFs are NaN, with a RuntimeWarning, where nV sig^2 > 1.
+	'''
+	nV, sig = np.broadcast_arrays(np.asarray(nV, dtype=float), np.asarray(sig, dtype=float))
+	bad = _unphysical(nV.ravel(), sig.ravel())
+	series = _PGaussianSeries(np.where(bad, 0, nV.ravel()), sig.ravel())
+	P = np.array([next(series) for k in range(kmax + 1)])
+	below = np.cumsum(P, axis=0)
+	need = (below[-1] > 0.5) & ~bad
+	tail = np.zeros(np.count_nonzero(need))
+	# carry on with the same series on the elements still summing their tail, t for those
+	# at positions active of tail; the terms decrease past the mode, so once a term is below
+	# the rounding of the sum so is the rest
+	active, t = np.arange(len(tail)), tail.copy()
+	p = series.send(need)
+	while len(active):
+		t += p
+		done = p <= 0.5 * np.finfo(float).eps * t
+		if done.any():
+			tail[active[done]] = t[done]
+			active, t = active[~done], t[~done]
+			p = series.send(~done)
+		else:
+			p = next(series)
+	# add the P_j for kmax >= j > k from the small end
+	upper = np.concatenate([np.cumsum(P[:0:-1, need], axis=0)[::-1], np.zeros((1, len(tail)))]) + tail
+	cdf = 1 - below
+	cdf[:, need] = np.where(below[:, need] > 0.5, upper, cdf[:, need])
+	cdf[:, bad] = np.nan
+	return cdf.reshape((kmax + 1,) + nV.shape)
+
+def _GaussianCurvature(kmax, nV, sig, kind="CDF"):
+	''' Second derivatives f_xx (x = log nV) and f_sigsig of PGaussianAll (kind="P") or
+	CDFGaussianAll for k = 0..kmax. Differentiating the generating function G brings down
+	powers of (x-1), d_nV G = ((x-1) + nV sig^2 (x-1)^2) G and d_sig G = nV^2 sig (x-1)^2 G,
+	and the coefficient of (x-1)^m G is the m-th backward difference of P_k (P_j = 0 for
+	j < 0). The CDF, 1 - sum_{j<=k} P_j, is the coefficient of (1-G)/(1-x), which removes
+	one factor (x-1) and one order of difference. '''
+	P = PGaussianAll(kmax, nV, sig)
+	P = np.concatenate([np.zeros((4,) + P.shape[1:]), P])
+	shift = 1 if kind == "CDF" else 0
+	T = [sum(math.comb(m - shift, i) * (-1)**(m - shift - i) * P[4 - i:len(P) - i] for i in range(m - shift + 1))
+		for m in range(5)]
+	s2 = sig**2
+	fnV = T[1] + nV * s2 * T[2]
+	fnVnV = (1 + s2) * T[2] + 2 * nV * s2 * T[3] + nV**2 * s2**2 * T[4]
+	return nV * fnV + nV**2 * fnVnV, nV**2 * T[2] + nV**4 * s2 * T[4]
+
+class GaussianTable:
+	''' CDFGaussianAll (or PGaussianAll with kind="P") tabulated once on a grid uniform in
+	log(nV) and in sig for k = 0..kmax, for likelihood loops that evaluate the model many
+	times on the same nV while only sig changes. sig = 0 is the Poisson limit, so PPoisson
+	and the Erlang CDFs are the first row of the table when sig_range starts at 0.
+	Lookups interpolate bilinearly and are clamped to the grid; inputs outside the grid or
+	in a cell that reaches nV sig^2 > 1 give a RuntimeWarning.
+
+	error[k] bounds max |table - exact| for each k over the cells that lie within
+	nV sig^2 <= 1, where all P_{k|V} are non-negative; beyond it the series is unphysical
+	and the table holds NaN, so lookups in cells reaching it are NaN too. Per cell the bilinear interpolation error
+	is at most h_x^2/8 max|f_xx| + h_sig^2/8 max|f_sigsig|. The second derivatives are the
+	analytic ones (_GaussianCurvature), taken at the corners, edge midpoints and centre of
+	the cell, and their maximum over the cell is that of these nine values plus half the
+	largest change between neighbouring ones. The storage rounding is added on top.
+	'''
+	def __init__(self, kmax, nV_range=(1e-3, 1e2), sig_range=(0., 1.), nnV=2048, nsig=256,
+			kind="CDF", dtype=np.float32):
+		self.kmax, self.kind = kmax, kind
+		self.x = np.linspace(np.log(nV_range[0]), np.log(nV_range[1]), nnV)
+		self.sig = np.linspace(sig_range[0], sig_range[1], nsig)
+		with warnings.catch_warnings():
+			# the grid reaches nV sig^2 > 1 on purpose; those nodes are NaN
+			warnings.simplefilter("ignore", RuntimeWarning)
+			self.values = self._exact(np.exp(self.x)[None, :], self.sig[:, None]).astype(dtype)
+		# a cell counts if all its corners are physical
+		physical = np.exp(self.x)[None, :] * self.sig[:, None]**2 <= 1
+		vmax = np.where(physical, np.abs(self.values), 0).max(axis=(1, 2))
+		self.error = self._bound(physical[1:, 1:]) + np.finfo(dtype).eps * vmax
+
+	def _bound(self, cells, rows=16):
+		''' Largest interpolation error bound for each k over the cells selected by cells,
+		working on rows cells in sig at a time. '''
+		hx, hs = self.x[1] - self.x[0], self.sig[1] - self.sig[0]
+		xr = np.linspace(self.x[0], self.x[-1], 2 * len(self.x) - 1)
+		def cellmax(f):
+			# f on the grid refined by two, so every cell holds 3x3 samples
+			nj, ni = (f.shape[1] - 1) // 2, (f.shape[2] - 1) // 2
+			m = step = 0
+			for dj in range(3):
+				for di in range(3):
+					s = f[:, dj:dj + 2 * nj:2, di:di + 2 * ni:2]
+					m = np.maximum(m, s)
+					if dj < 2:
+						step = np.maximum(step, np.abs(f[:, dj + 1:dj + 1 + 2 * nj:2, di:di + 2 * ni:2] - s))
+					if di < 2:
+						step = np.maximum(step, np.abs(f[:, dj:dj + 2 * nj:2, di + 1:di + 1 + 2 * ni:2] - s))
+			return m + step / 2
+		bound = np.zeros(self.kmax + 1)
+		for j in range(0, len(self.sig) - 1, rows):
+			j1 = min(j + rows, len(self.sig) - 1)
+			sr = np.linspace(self.sig[j], self.sig[j1], 2 * (j1 - j) + 1)
+			with np.errstate(all='ignore'), warnings.catch_warnings():
+				warnings.simplefilter("ignore", RuntimeWarning)
+				fxx, fss = _GaussianCurvature(self.kmax, np.exp(xr)[None, :], sr[:, None], self.kind)
+				b = hx**2 / 8 * cellmax(np.abs(fxx)) + hs**2 / 8 * cellmax(np.abs(fss))
+			bound = np.maximum(bound, np.where(cells[j:j1], b, 0).max(axis=(1, 2)))
+		return bound
+
+	def _exact(self, nV, sig):
+		return {"CDF": CDFGaussianAll, "P": PGaussianAll}[self.kind](self.kmax, nV, sig)
+
+	def __call__(self, k, nV, sig, check=True):
+		''' Interpolated model for rank(s) k at nV and sig, all broadcast against each other. '''
+		fx = (np.log(nV) - self.x[0]) / (self.x[1] - self.x[0])
+		fs = (np.asarray(sig) - self.sig[0]) / (self.sig[1] - self.sig[0])
+		outside = (fx < 0) | (fx > len(self.x) - 1) | (fs < 0) | (fs > len(self.sig) - 1)
+		fx = np.clip(fx, 0, len(self.x) - 1)
+		fs = np.clip(fs, 0, len(self.sig) - 1)
+		i = np.minimum(fx.astype(int), len(self.x) - 2)
+		j = np.minimum(fs.astype(int), len(self.sig) - 2)
+		if check:
+			self._check(outside, np.exp(self.x[i + 1]) * self.sig[j + 1]**2 > 1)
+		tx, ts = fx - i, fs - j
+		v = self.values
+		return ((1 - ts) * ((1 - tx) * v[k, j, i] + tx * v[k, j, i + 1])
+			+ ts * ((1 - tx) * v[k, j + 1, i] + tx * v[k, j + 1, i + 1]))
+
+	def fixed_nV(self, nV):
+		''' Returns model(sig) giving the table for all k at these nV, shape (kmax+1, len(nV)).
+		The interpolation in nV is done here once, so every call only blends two
+		precomputed rows in sig, which is what an MCMC over sig needs. '''
+		fx = (np.log(nV) - self.x[0]) / (self.x[1] - self.x[0])
+		self._check((fx < 0) | (fx > len(self.x) - 1), False)
+		fx = np.clip(fx, 0, len(self.x) - 1)
+		i = np.minimum(fx.astype(int), len(self.x) - 2)
+		tx = (fx - i).astype(self.values.dtype)
+		rows = (1 - tx) * self.values[:, :, i] + tx * self.values[:, :, i + 1]
+		rows = np.ascontiguousarray(rows.transpose(1, 0, 2)) # one contiguous block per sig
+		s0, ds, ns = float(self.sig[0]), float(self.sig[1] - self.sig[0]), len(self.sig)
+		# largest nV sig^2 at the far corner of the cells, for each cell in sig
+		corner = (float(np.exp(self.x[i + 1]).max()) * self.sig[1:]**2).tolist()
+		def model(sig):
+			fs = (float(sig) - s0) / ds
+			outside = not 0 <= fs <= ns - 1
+			fs = min(max(fs, 0.), ns - 1.)
+			j = min(int(fs), ns - 2)
+			if outside or corner[j] > 1:
+				self._check(outside, corner[j] > 1)
+			return (1 - (fs - j)) * rows[j] + (fs - j) * rows[j + 1]
+		return model
+
+	def _check(self, outside, unphysical):
+		if np.any(outside):
+			warnings.warn("GaussianTable lookup outside the tabulated nV or sig range is clamped to its edge",
+				RuntimeWarning, stacklevel=3)
+		if np.any(unphysical):
+			warnings.warn("GaussianTable lookup in a cell reaching nV sig^2 > 1, where the Gaussian P_{k|V} "
+				"are unphysical and the table holds NaN", RuntimeWarning, stacklevel=3)
+
+	def save(self, filename):
+		# through a file handle, so np.savez does not append .npz and load finds the same name
+		with open(filename, "wb") as f:
+			np.savez(f, values=self.values, x=self.x, sig=self.sig, error=self.error, kind=self.kind)
+
+	@classmethod
+	def load(cls, filename):
+		table = cls.__new__(cls)
+		with np.load(filename) as f:
+			table.values, table.x, table.sig, table.error = f["values"], f["x"], f["sig"], f["error"]
+			table.kind = str(f["kind"])
+		table.kmax = len(table.values) - 1
+		return table
+
 ''' This code is generated with Mathematica. 
 Here it is the source, just in case you ever need to change anything.
 PG[n_] := 
@@ -0,0 +1,231 @@
+''' Benchmarks and regression checks for the hot paths of kNN_CDFs and kNN_analytic.
+
+	python kNN_benchmarks.py [--quick] [--out results.json] [--compare baseline.json]
+
+Every benchmark records its best wall time over a few repeats, a rate (points or
+evaluations per second) and its peak memory, the growth of the peak resident set size
+of a forked process that runs it once. Unlike tracemalloc this sees what cKDTree
+allocates in C++ as well as the NumPy arrays. Accuracy checks compare against the
+Poisson limit numerically instead of by plots. The results are written as JSON; with --compare, timings more than
+--tolerance times slower than the baseline are reported as regressions. The exit status
+is non-zero if an accuracy check or the comparison fails.
+'''
+import sys
+import json
+import time
+import argparse
+import platform
+import ctypes
+import resource
+import multiprocessing
+import numpy as np
+import scipy
+import scipy.spatial
+from scipy.special import gammainc
+from kNN_CDFs import VolumekNN, CDFkNN, CDFkNNBatch, CDFkNNCross, _Cr
+from kNN_analytic import PGaussian, CDFGaussian, PGaussianAll, CDFGaussianAll
+
+def measure(func, repeat=3):
+	''' Best wall time of func() over repeat calls and the peak memory of one call. '''
+	best = np.inf
+	for i in range(repeat):
+		t0 = time.perf_counter()
+		func()
+		best = min(best, time.perf_counter() - t0)
+	return best, peak_rss(func)
+
+def peak_rss(func):
+	''' Bytes by which one call of func() raises the peak resident set size, measured in a
+	forked process so that earlier benchmarks do not hide it. '''
+	ctx = multiprocessing.get_context("fork")
+	recv, send = ctx.Pipe(duplex=False)
+	child = ctx.Process(target=_peak_rss, args=(func, send))
+	child.start()
+	peak = recv.recv()
+	child.join()
+	return peak
+
+def _peak_rss(func, conn):
+	try: # hand back the heap the parent freed, or func would reuse it unseen
+		ctypes.CDLL(None).malloc_trim(0)
+	except (OSError, AttributeError): # not glibc
+		pass
+	try: # Linux: restart the peak (VmHWM) from the current size
+		with open("/proc/self/clear_refs", "w") as f:
+			f.write("5")
+		peak = lambda: _proc_status("VmHWM")
+		before = _proc_status("VmRSS")
+	except OSError: # elsewhere the peak only grows, so the parent's may hide part of it
+		scale = 1 if sys.platform == "darwin" else 1024
+		peak = lambda: scale * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		before = peak()
+	func()
+	conn.send(peak() - before)
+
+def _proc_status(key):
+	with open("/proc/self/status") as f:
+		return 1024 * int(next(line.split()[1] for line in f if line.startswith(key + ":")))
+
+def points(N, dim, boxsize, seed=42):
+	return np.random.default_rng(seed).uniform(0, boxsize, (N, dim))
+
+def PoissonCDF(k, nV):
+	''' Probability that the k-th neighbour volume is below V for a Poisson process, i.e.
+	the regularized incomplete gamma function, which stays accurate where it is tiny. '''
+	return gammainc(k, nV)
+
+def bench_tree(Ns, dims, boxsize=1.):
+	for N in Ns:
+		for dim in dims:
+			for periodic in (0, boxsize):
+				x = points(N, dim, boxsize)
+				t, mem = measure(lambda: scipy.spatial.cKDTree(x, boxsize=periodic))
+				yield dict(name="tree_build", N=N, dim=dim, periodic=bool(periodic),
+					time=t, peak_bytes=mem, rate=N / t)
+
+def bench_query(Ns, ks, dims, boxsize=1.):
+	for N in Ns:
+		for dim in dims:
+			for k in ks:
+				for periodic in (0, boxsize):
+					x, q = points(N, dim, boxsize), points(N, dim, boxsize, seed=1)
+					t, mem = measure(lambda: VolumekNN(x, q, k=k, periodic=periodic))
+					yield dict(name="VolumekNN", N=N, dim=dim, k=k, periodic=bool(periodic),
+						time=t, peak_bytes=mem, rate=N / t)
+
+def bench_cdfknn(N, kneighbors, boxsize=1.):
+	x, q = points(N, 3, boxsize), points(N, 3, boxsize, seed=1)
+	for compress in ("none", "log"):
+		for compact in (False, True):
+			t, mem = measure(lambda: CDFkNN(x, q, kneighbors, periodic=boxsize, compress=compress,
+				compact=compact))
+			yield dict(name="CDFkNN", N=N, nk=len(kneighbors), compress=compress, compact=compact,
+				time=t, peak_bytes=mem, rate=N / t)
+
+def bench_analytic(n, kmax=13):
+	nV = np.logspace(-3, 1.5, n)
+	sig = 0.3 * np.maximum(nV, 1)**-0.5
+	with np.errstate(all='ignore'):
+		for name, func in (("PGaussian", lambda: [PGaussian(k, nV, sig) for k in range(kmax + 1)]),
+				("CDFGaussian", lambda: [CDFGaussian(k, nV, sig) for k in range(kmax + 1)]),
+				("PGaussianAll", lambda: PGaussianAll(kmax, nV, sig)),
+				("CDFGaussianAll", lambda: CDFGaussianAll(kmax, nV, sig))):
+			t, mem = measure(func)
+			yield dict(name=name, n=n, kmax=kmax, time=t, peak_bytes=mem, rate=n * (kmax + 1) / t)
+
+def check_accuracy(N, ks, dims):
+	''' Each check reports its error and the threshold it must stay below. '''
+	nV = np.logspace(-4, 2, 2000)
+	with np.errstate(all='ignore'):
+		err = max(np.nanmax(np.abs(CDFGaussian(k, nV, 0) - PoissonCDF(k + 1, nV))) for k in range(14))
+	yield dict(name="CDFGaussian(sig=0) vs Poisson", error=err, threshold=1e-8)
+	err = max(np.max(np.abs(CDFGaussianAll(40, nV, 0)[k] - PoissonCDF(k + 1, nV))) for k in range(41))
+	yield dict(name="CDFGaussianAll(sig=0) vs Poisson", error=err, threshold=1e-8)
+	# Relative errors where the CDF is small, which an absolute threshold cannot see.
+	# CDFGaussian for k <= 13 are the closed forms, which subtract from 1 and are not
+	# meant for the far tail, so only the recursion is held to this.
+	ref = PoissonCDF(np.arange(1, 42)[:, None], nV)
+	tail = (ref > 1e-300) & (ref < 1e-3)
+	err = np.max(np.abs(CDFGaussianAll(40, nV, 0)[tail] / ref[tail] - 1))
+	yield dict(name="CDFGaussianAll tail, relative", error=err, threshold=1e-10)
+	err = max(np.max(np.abs(CDFGaussian(k, nV, 0)[tail[k]] / ref[k][tail[k]] - 1)) for k in range(14, 41))
+	yield dict(name="CDFGaussian k>13 tail, relative", error=err, threshold=1e-10)
+	# Volumes of a Poisson sample: the largest CDF difference to the Erlang law is a
+	# Kolmogorov-Smirnov distance. Query points closer than the k-th neighbour distance
+	# see correlated volumes, so only about N/k of them are used, and 1.95/sqrt(Nq) is
+	# the 0.1% critical value.
+	for dim in dims:
+		x = points(N, dim, 1.)
+		for k in ks:
+			Nq = max(N // k, 100)
+			v = np.sort(VolumekNN(x, points(Nq, dim, 1., seed=k), k=k, periodic=1.)[:, 0])
+			ecdf = np.arange(1, Nq + 1) / Nq
+			err = max(np.max(np.abs(ecdf - PoissonCDF(k, N * v))), np.max(np.abs(ecdf - 1 / Nq - PoissonCDF(k, N * v))))
+			yield dict(name="VolumekNN vs Poisson", dim=dim, k=k, error=err, threshold=1.95 / np.sqrt(Nq))
+	# the grid engine moves every kNN distance by at most hm*(sqrt(dim)+1)/2, on a lattice
+	# with one node per 2^dim points; the error is that largest shift over the bound
+	for dim in dims:
+		x = points(N, dim, 1.)
+		n = int(round(N**(1 / dim) / 2))
+		lattice = (np.indices((n,) * dim).reshape(dim, -1).T + 0.5) / n
+		r = [(VolumekNN(x, lattice, ks, periodic=1., engine=engine) / _Cr(dim))**(1 / dim)
+			for engine in ("kdtree", "grid")]
+		err = np.max(np.abs(r[1] - r[0])) / ((np.sqrt(dim) + 1) / (2 * n))
+		yield dict(name="grid engine distance bound", dim=dim, error=err, threshold=1 + 1e-9)
+	# the approx engine's volumes lie in [V, (1+eps)^dim V], which brackets its CDF; the
+	# error is the largest ratio to the upper end, or inf if any volume is below V
+	eps = 0.1
+	for dim in dims:
+		x, q = points(N, dim, 1.), points(N // 10, dim, 1., seed=1)
+		ratio = VolumekNN(x, q, ks, periodic=1., engine="approx", eps=eps) / VolumekNN(x, q, ks, periodic=1.)
+		err = ratio.max() / (1 + eps)**dim if ratio.min() >= 1 else np.inf
+		yield dict(name="approx engine CDF bracket", dim=dim, eps=eps, error=err, threshold=1 + 1e-12)
+	# the catalogs of a batch handed to worker processes must come back as computed in process
+	x, q = points(N, 3, 1.), points(N // 10, 3, 1., seed=1)
+	labels = np.arange(N) % 4
+	serial = CDFkNNBatch(x, q, ks, periodic=1., labels=labels, jackknife=True)
+	forked = CDFkNNBatch(x, q, ks, periodic=1., labels=labels, jackknife=True, executor="process", nprocs=2)
+	yield dict(name="CDFkNNBatch process vs in process", error=np.max(np.abs(forked - serial)), threshold=1e-12)
+	# streamed weighted volumes must stay inside the histogram range, where the in-memory ones are
+	# (10^4 points of total weight 4 give volumes near 1/4, far above 1e3 times the volume per point)
+	xw, qw = points(10**4, 3, 1., seed=2), points(200, 3, 1., seed=3)
+	w = np.full(len(xw), 4. / len(xw))
+	cdfs = [CDFkNNCross({"w": xw}, qw, 1, periodic=1., weights={"w": w}, chunksize=chunksize)[("w", 1)]
+		for chunksize in (None, 50)]
+	yield dict(name="CDFkNNCross weighted streamed", error=abs(cdfs[1].mean() / cdfs[0].mean() - 1), threshold=1e-2)
+
+def compare(results, baseline, tolerance):
+	''' Benchmarks at least tolerance times slower than the entry with the same parameters in baseline. '''
+	key = lambda r: json.dumps({k: v for k, v in r.items() if k not in ("time", "peak_bytes", "rate")},
+		sort_keys=True)
+	old = {key(r): r for r in baseline["benchmarks"]}
+	for r in results["benchmarks"]:
+		if key(r) in old and r["time"] > tolerance * old[key(r)]["time"]:
+			yield dict(r, baseline_time=old[key(r)]["time"])
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument("--quick", action="store_true", help="small sizes, for a smoke test")
+	parser.add_argument("--out", help="write the JSON results to this file instead of stdout")
+	parser.add_argument("--compare", help="JSON results of an earlier run to check for regressions")
+	parser.add_argument("--tolerance", type=float, default=1.5)
+	args = parser.parse_args(argv)
+
+	Ns = [10**4, 10**5] if args.quick else [10**4, 10**5, 10**6]
+	ks = [1, 8, 64]
+	dims = [1, 2, 3]
+	benchmarks = []
+	for bench in (bench_tree(Ns, dims), bench_query(Ns, ks, dims),
+			bench_cdfknn(Ns[-1], np.arange(1, 17)), bench_analytic(10**4 if args.quick else 10**6)):
+		for r in bench:
+			params = " ".join("%s=%s" % kv for kv in r.items() if kv[0] not in ("name", "time", "peak_bytes", "rate"))
+			print("%-16s %-40s %9.4f s %10.3g /s %8.1f MB" % (r["name"], params, r["time"], r["rate"],
+				r["peak_bytes"] / 2**20), file=sys.stderr)
+			benchmarks.append(r)
+	accuracy = list(check_accuracy(Ns[0] if args.quick else Ns[1], ks, dims))
+	for r in accuracy:
+		r["passed"] = bool(r["error"] < r["threshold"])
+		params = " ".join("%s=%s" % kv for kv in r.items() if kv[0] not in ("name", "error", "threshold", "passed"))
+		print("%-36s %-12s %10.3g < %10.3g %s" % (r["name"], params, r["error"], r["threshold"],
+			"ok" if r["passed"] else "FAILED"), file=sys.stderr)
+
+	results = dict(benchmarks=benchmarks, accuracy=accuracy, python=platform.python_version(),
+		numpy=np.__version__, scipy=scipy.__version__, machine=platform.machine(),
+		timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"))
+	failed = not all(r["passed"] for r in accuracy)
+	if args.compare:
+		with open(args.compare) as f:
+			results["regressions"] = list(compare(results, json.load(f), args.tolerance))
+		for r in results["regressions"]:
+			print("regression: %s %.4f s, was %.4f s" % (r["name"], r["time"], r["baseline_time"]), file=sys.stderr)
+		failed = failed or bool(results["regressions"])
+	text = json.dumps(results, indent=1, default=float)
+	if args.out:
+		with open(args.out, "w") as f:
+			f.write(text)
+	else:
+		print(text)
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,103 @@
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import scipy.spatial
+
+class kNNCache:
+    ''' Keeps kNN trees and per-k volume arrays so that repeated measurements on the same
+    catalog skip the tree build and, for the same query points, the neighbour search.
+    Entries are keyed by a hash of the data (and query) coordinates plus the boxsize.
+    In memory the cache is an LRU bounded by maxbytes. With a path, every entry is also
+    written to that directory (trees pickled, volumes as .npy which are read back
+    memory-mapped) and survives the process.
+
+    Pass the same instance as cache= to VolumekNN, HistogramkNN, CDFkNN or CDFkNNDD.
+    '''
+    def __init__(self, maxbytes=2**30, path=None):
+        self.maxbytes = maxbytes
+        self.path = path
+        self.nbytes = 0
+        self._store = OrderedDict()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def digest(x, block=2**20):
+        ''' Hash of the shape, dtype and contents of x, read in blocks of rows so that
+        memory-mapped arrays are not loaded whole. '''
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr((x.shape, x.dtype.str)).encode())
+        for i in range(0, len(x), block):
+            h.update(np.ascontiguousarray(x[i:i + block]))
+        return h.hexdigest()
+
+    def tree(self, xin, periodic=0):
+        key = "tree-%s-%s" % (self.digest(xin), self.digest(np.atleast_1d(periodic)))
+        xtree = self._get(key, ".pkl")
+        if xtree is None:
+            xtree = scipy.spatial.cKDTree(xin, boxsize=periodic)
+            self._put(key, ".pkl", xtree, xtree.data.nbytes + xtree.indices.nbytes + 64 * xtree.size)
+        return xtree
+
+    def volumes(self, xin, xout, k, periodic=0, compute=None):
+        ''' Volumes for every k in the list k, one column each. Columns not yet cached
+        are obtained in one call compute(missing_k) returning an array with one column
+        per missing k. Query points that are not an array or .npy path (e.g. generators)
+        cannot be hashed and are passed straight to compute. '''
+        if isinstance(xout, (str, os.PathLike)):
+            xout = np.load(xout, mmap_mode='r')
+        if not isinstance(xout, np.ndarray):
+            return compute(list(k))
+        base = "vol-%s-%s-%s" % (self.digest(xin), self.digest(xout), self.digest(np.atleast_1d(periodic)))
+        cols = {kk: self._get("%s-%d" % (base, kk), ".npy") for kk in k}
+        missing = [kk for kk in k if cols[kk] is None]
+        if missing:
+            vol = compute(missing)
+            for c, kk in enumerate(missing):
+                cols[kk] = np.ascontiguousarray(vol[:, c])
+                self._put("%s-%d" % (base, kk), ".npy", cols[kk], cols[kk].nbytes)
+        return np.stack([cols[kk] for kk in k], axis=1)
+
+    def clear(self):
+        ''' Empties the in-memory part of the cache. Files on disk are kept. '''
+        self._store.clear()
+        self.nbytes = 0
+
+    def _file(self, key, ext):
+        return os.path.join(self.path, key + ext)
+
+    def _get(self, key, ext):
+        if key in self._store:
+            self._store.move_to_end(key)
+            return self._store[key][0]
+        if self.path is None or not os.path.exists(self._file(key, ext)):
+            return None
+        if ext == ".npy":
+            obj = np.load(self._file(key, ext), mmap_mode='r')
+            nbytes = 0 # pages belong to the OS page cache
+        else:
+            with open(self._file(key, ext), "rb") as f:
+                obj = pickle.load(f)
+            nbytes = obj.data.nbytes + obj.indices.nbytes + 64 * obj.size
+        self._remember(key, obj, nbytes)
+        return obj
+
+    def _put(self, key, ext, obj, nbytes):
+        if self.path is not None:
+            if ext == ".npy":
+                np.save(self._file(key, ext), obj)
+            else:
+                with open(self._file(key, ext), "wb") as f:
+                    pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._remember(key, obj, nbytes)
+
+    def _remember(self, key, obj, nbytes):
+        if nbytes > self.maxbytes:
+            return
+        self._store[key] = (obj, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.maxbytes:
+            _, (_, n) = self._store.popitem(last=False)
+            self.nbytes -= n
@@ -0,0 +1,103 @@
+import numpy as np
+import scipy.spatial
+from kNN_CDFs import _Cr, _fit
+
+class IncrementalkNN:
+    ''' kNN volumes of a fixed set of query points for a catalog that changes in batches,
+    e.g. lightcone shells or a streaming survey. For every query point the distances to
+    (and ids of) its kmax nearest data points are kept. insert() and delete() recompute
+    only the query points whose kmax-neighbourhood the changed points fall into; finding
+    those takes one nearest-neighbour query per query point against the inserted batch,
+    or a lookup of the deleted ids, so memory does not grow with the catalog.
+
+    Data points live in batches, one tree per inserted batch, and deleted points are
+    only flagged dead. Call compact() once many batches or deletions have piled up.
+    '''
+    def __init__(self, xout, kmax, periodic=0):
+        self.xout = np.asarray(xout)
+        self.kmax = kmax
+        self.periodic = periodic
+        self.dis = np.full((len(self.xout), kmax), np.inf)
+        self.ids = np.full((len(self.xout), kmax), -1, dtype=np.int64)
+        self._batches = [] # [tree, ids of its points, alive mask]
+        self._batch = np.empty(0, dtype=np.int64) # batch and position in it, by id; -1 once compacted away
+        self._local = np.empty(0, dtype=np.int64)
+
+    def insert(self, x):
+        ''' Adds the data points x and returns the ids given to them. '''
+        x = np.asarray(x)
+        xtree = scipy.spatial.cKDTree(x, boxsize=self.periodic)
+        ids = np.arange(len(self._batch), len(self._batch) + len(x))
+        self._batches.append([xtree, ids, np.ones(len(x), dtype=bool)])
+        self._batch = np.concatenate([self._batch, np.full(len(x), len(self._batches) - 1)])
+        self._local = np.concatenate([self._local, np.arange(len(x))])
+        # every query point has its own kmax distance, so ask the new tree for the nearest
+        # new point of each rather than searching one radius that suits the farthest
+        d1, _ = xtree.query(self.xout, k=1, workers=-1)
+        rows = np.flatnonzero(d1 < self.dis[:, -1])
+        if len(rows):
+            dis, idx = self._query(xtree, rows, min(self.kmax, len(x)))
+            self._merge(rows, dis, np.where(np.isfinite(dis), ids[np.minimum(idx, len(x) - 1)], -1))
+        return ids
+
+    def delete(self, ids):
+        ''' Removes the data points with these ids and recomputes the neighbours of the
+        query points that had any of them among their kmax nearest. Ids that were already
+        deleted are ignored. '''
+        ids = np.atleast_1d(ids)
+        ids = ids[self._batch[ids] >= 0]
+        which = self._batch[ids]
+        for b in np.unique(which):
+            xtree, bids, alive = self._batches[b]
+            alive[self._local[ids[which == b]]] = False
+        rows = np.flatnonzero(np.isin(self.ids, ids).any(axis=1))
+        if not len(rows):
+            return
+        self.dis[rows] = np.inf
+        self.ids[rows] = -1
+        for xtree, bids, alive in self._batches:
+            if not alive.any():
+                continue
+            # dead points still sit in the tree, so ask for more neighbours and double
+            # that for the rows that found fewer than kmax alive ones
+            todo, k = rows, min(2 * self.kmax, len(alive))
+            while len(todo):
+                dis, idx = self._query(xtree, todo, k)
+                valid = np.isfinite(dis)
+                valid[valid] = alive[idx[valid]]
+                done = (valid.sum(axis=1) >= self.kmax) | (k == len(alive))
+                self._merge(todo[done], np.where(valid, dis, np.inf)[done],
+                            np.where(valid, bids[np.minimum(idx, len(bids) - 1)], -1)[done])
+                todo, k = todo[~done], min(2 * k, len(alive))
+
+    def compact(self):
+        ''' Rebuilds a single tree from the points still alive, keeping their ids. '''
+        x = np.concatenate([xtree.data[alive] for xtree, bids, alive in self._batches])
+        ids = np.concatenate([bids[alive] for xtree, bids, alive in self._batches])
+        self._batches = [[scipy.spatial.cKDTree(x, boxsize=self.periodic), ids, np.ones(len(x), dtype=bool)]]
+        self._batch[:] = -1
+        self._local[:] = -1
+        self._batch[ids] = 0
+        self._local[ids] = np.arange(len(x))
+
+    def volumes(self, k):
+        ''' kNN volumes of all query points for the ranks in k, one column per k. '''
+        dim = self.xout.shape[1]
+        return _Cr(dim) * self.dis[:, np.atleast_1d(k) - 1]**dim
+
+    def cdfs(self, kneighbors=1, compress="none", Ninterpolants=500):
+        ''' The current kNN CDFs, as returned by CDFkNN. '''
+        kneighbors = np.atleast_1d(kneighbors)
+        vol = self.volumes(kneighbors)
+        return _fit(lambda c: vol[:,c], kneighbors, compress, Ninterpolants, False, None, None)
+
+    def _query(self, xtree, rows, k):
+        dis, idx = xtree.query(self.xout[rows], k=k, workers=-1)
+        return dis.reshape(len(rows), -1), idx.reshape(len(rows), -1)
+
+    def _merge(self, rows, dis, ids):
+        d = np.concatenate([self.dis[rows], dis], axis=1)
+        i = np.concatenate([self.ids[rows], ids], axis=1)
+        order = np.argsort(d, axis=1, kind='stable')[:, :self.kmax]
+        self.dis[rows] = np.take_along_axis(d, order, axis=1)
+        self.ids[rows] = np.take_along_axis(i, order, axis=1)
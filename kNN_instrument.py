@@ -0,0 +1,92 @@
+import sys
+import time
+import contextlib
+import tracemalloc
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+class kNNProfile:
+    ''' Per-stage timers and memory counters for a kNN-CDF run. Pass an instance as
+    profile= to VolumekNN, HistogramkNN, CDFkNN or CDFkNNDD and read report() afterwards,
+    or give a sink that receives the report when each call returns (once: CDFkNN running
+    VolumekNN inside reports when CDFkNN returns). The stages are
+      tree       building the cKDTree (or fetching it from a kNNCache)
+      query      cKDTree.query; with a parallel executor this is the time spent waiting
+                 for the workers, which includes their volume conversion
+      volumes    turning distances into volumes
+      histogram  binning volumes in the chunked (chunksize=) path
+      fit        building the SE_distribution or CDFArray results
+    progress(done, total) is called as query points are finished; total is None when
+    the query points come from a generator. With memory=True tracemalloc records the
+    peak memory of every stage as peak_traced_bytes, which costs some speed. tracemalloc
+    only sees Python and NumPy allocations, not the nodes cKDTree builds in C++, so the
+    tree and query stages use more than it reports (a 1e6-point tree shows 8 MB of its
+    about 28 MB). The peak resident size of the process, maxrss_bytes, includes all of
+    it and is always reported.
+    '''
+    def __init__(self, progress=None, sink=None, memory=False):
+        self.progress, self.sink, self.memory = progress, sink, memory
+        self.stages = {}
+        self.done, self.total = 0, None
+        self._start = time.perf_counter()
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def stage(self, name, items=0):
+        s = self.stages.setdefault(name, dict(time=0., calls=0, items=0))
+        if self.memory:
+            started = not tracemalloc.is_tracing()
+            if started: tracemalloc.start()
+            tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            s["time"] += time.perf_counter() - t0
+            s["calls"] += 1
+            s["items"] += items
+            if self.memory:
+                s["peak_traced_bytes"] = max(s.get("peak_traced_bytes", 0), tracemalloc.get_traced_memory()[1])
+                if started: tracemalloc.stop()
+
+    def advance(self, n):
+        self.done += int(n)
+        if self.progress is not None:
+            self.progress(self.done, self.total)
+
+    def report(self):
+        report = dict(stages={name: dict(s) for name, s in self.stages.items()},
+                      total_time=time.perf_counter() - self._start, query_points=self.done)
+        if resource is not None:
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            report["maxrss_bytes"] = maxrss if sys.platform == "darwin" else 1024 * maxrss
+        return report
+
+    @contextlib.contextmanager
+    def run(self):
+        ''' Brackets a public call. Calls nest (CDFkNN runs VolumekNN), and only the
+        outermost one calls finish() when it returns. '''
+        self._depth += 1
+        try:
+            yield self
+        finally:
+            self._depth -= 1
+        if self._depth == 0:
+            self.finish()
+
+    def finish(self):
+        ''' Called at the end of a run; hands the report to the sink. '''
+        if self.sink is not None:
+            self.sink(self.report())
+
+class _NullProfile:
+    ''' Stands in when no profile is given, so the pipeline can call it unconditionally. '''
+    total = None
+    def stage(self, name, items=0): return contextlib.nullcontext()
+    def advance(self, n): pass
+    def run(self): return contextlib.nullcontext()
+    def finish(self): pass
+
+NullProfile = _NullProfile()